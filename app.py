@@ -1,17 +1,45 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, abort
+from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, make_response, g
 import sqlite3
 import os
 import uuid
-from datetime import datetime, timedelta
-from typing import List, Optional
+import json
+import time
+import queue
+import threading
+import atexit
+import hmac
+import hashlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterator, List, Optional
+from werkzeug.security import check_password_hash
 
 app = Flask(__name__)
 app.secret_key = 'clave_secreta'  # cámbiala por una segura
 
+# ---------------------------
+# Credenciales admin (desde el entorno, nunca en el código)
+# ---------------------------
+# ADMIN_USER_HASH: sha256 (hex) del usuario
+#   python -c "import hashlib; print(hashlib.sha256(b'usuario').hexdigest())"
+# ADMIN_PW_HASH: hash de werkzeug de la contraseña
+#   python -c "from werkzeug.security import generate_password_hash as g; print(g('clave'))"
+ADMIN_USER_HASH = os.environ.get('ADMIN_USER_HASH', '').strip().lower()
+ADMIN_PW_HASH = os.environ.get('ADMIN_PW_HASH', '').strip()
+
+if not ADMIN_USER_HASH or not ADMIN_PW_HASH:
+    app.logger.warning("ADMIN_USER_HASH / ADMIN_PW_HASH no configurados: login admin deshabilitado")
+
 # ---------------------------
 # Config reservas
 # ---------------------------
 HOLD_MINUTES = 120  # reserva temporal por item (minutos)
+CLEANUP_INTERVAL = 60  # segundos entre barridos de holds expirados
+CATEGORIES_TTL = 300  # segundos que se cachean las categorías de la vitrina
+MAX_CART_ITEMS = 50  # tope de items por carrito
+ADMIN_PAGE_SIZE = 50  # filas por página en inventario / reservas
+ADMIN_PAGE_MAX = 200
 
 # Carpetas de subida
 UPLOAD_FOLDER_IMAGES = 'uploads/images'
@@ -20,14 +48,251 @@ UPLOAD_FOLDER_LOGO   = 'uploads/logo'
 for folder in (UPLOAD_FOLDER_IMAGES, UPLOAD_FOLDER_LOGO):
     os.makedirs(os.path.join('static', folder), exist_ok=True)
 
+# Escrituras/borrados de archivos fuera del hilo del request
+IO_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix='uploads-io')
+
+
+def _write_bytes(full_path: str, data: bytes) -> None:
+    with open(full_path, 'wb') as f:
+        f.write(data)
+
+
+def _remove_quietly(full_path: str) -> None:
+    try:
+        os.remove(full_path)
+    except OSError:
+        pass
+
+
+def _replace_logo(folder: str, full_path: str, data: bytes) -> None:
+    # escribir el nuevo, apuntar el cache a él y recién ahí borrar los anteriores:
+    # el logo servido siempre existe y, si la escritura falla, nada cambia
+    _write_bytes(full_path, data)
+    fn = os.path.basename(full_path)
+    _LOGO_CACHE['file'] = fn
+    for f in os.listdir(folder):
+        if f != fn:
+            _remove_quietly(os.path.join(folder, f))
+
+
+def _log_io_error(future) -> None:
+    exc = future.exception()
+    if exc is not None:
+        app.logger.error("Error escribiendo archivo subido: %s", exc)
+
+
+def submit_io(fn, *args) -> None:
+    IO_POOL.submit(fn, *args).add_done_callback(_log_io_error)
+
+
+# ---------------------------
+# Conexión DB (pool)
+# ---------------------------
+DB_PATH = 'database.db'
+DB_POOL_SIZE = 8
+DB_POOL_TIMEOUT = 10  # segundos esperando una conexión libre
+
+# PRAGMAs que se aplican a cada conexión nueva del pool
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA wal_autocheckpoint=1000",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+class ConnectionPool:
+    """
+    Pool de conexiones sqlite de larga vida (compartidas entre hilos).
+    Evita abrir el archivo en cada request y mantiene caliente el cache de páginas.
+    Las conexiones van en autocommit (isolation_level=None): las escrituras
+    de varios pasos abren su propia transacción con BEGIN.
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self._idle = queue.Queue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        # crear una conexión nueva si aún no llegamos al tamaño del pool
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # pool lleno: esperar a que otro hilo libere una, pero no para siempre
+        try:
+            return self._idle.get(timeout=DB_POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError("pool de conexiones agotado") from None
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        # nunca devolver al pool una conexión con transacción abierta
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self) -> None:
+        """
+        Cierra las conexiones libres; antes corre PRAGMA optimize para
+        que sqlite guarde estadísticas útiles para el planner.
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.execute("PRAGMA optimize")
+            except sqlite3.Error:
+                pass
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+atexit.register(pool.close)
+
+
+@contextmanager
+def db_conn():
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
 
 # ---------------------------
-# Conexión DB
+# SQL reutilizado
 # ---------------------------
-def get_db():
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+# Texto fijo a nivel de módulo: las consultas que antes eran f-strings ya no
+# se arman en cada request. (El cache de statements de sqlite3 va por texto,
+# así que los strings literales ya se reutilizaban: aquí solo se ahorra Python.)
+PRODUCT_COLUMNS = (
+    "p.id, p.name, p.code, p.category, p.description, p.price, p.image_path, "
+    "p.manufacturer, p.plant, p.unit, p.quantity, p.external_link"
+)
+
+# status "en vivo": un reserved cuyo hold ya expiró se muestra available
+# aunque el hilo de limpieza todavía no haya pasado (param: now epoch)
+PRODUCT_STATUS_SQL = (
+    "CASE WHEN p.status='reserved' AND EXISTS("
+    "SELECT 1 FROM holds h WHERE h.product_id=p.id AND h.expires_at <= ?"
+    ") THEN 'available' ELSE p.status END"
+)
+
+SQL_PRODUCTS_LIVE = f"SELECT {PRODUCT_COLUMNS}, {PRODUCT_STATUS_SQL} AS status FROM products p"
+SQL_PRODUCT_BY_ID = SQL_PRODUCTS_LIVE + " WHERE p.id=?"
+SQL_INVENTORY_PAGE = SQL_PRODUCTS_LIVE + " WHERE p.id < ? ORDER BY p.id DESC LIMIT ?"
+# el carrito son los holds vigentes de la sesión (params: sid, now epoch)
+SQL_SESSION_ITEMS = (
+    "SELECT p.* FROM holds h JOIN products p ON p.id = h.product_id "
+    "WHERE h.session_id=? AND h.expires_at > ? ORDER BY h.id"
+)
+# mismo filtro, con el total del carrito calculado por sqlite en la misma pasada
+SQL_CART_ITEMS = (
+    "SELECT p.*, SUM(COALESCE(p.price, 0)) OVER () AS cart_total "
+    "FROM holds h JOIN products p ON p.id = h.product_id "
+    "WHERE h.session_id=? AND h.expires_at > ? ORDER BY h.id"
+)
+SQL_CART_COUNT = "SELECT COUNT(*) FROM holds WHERE session_id=? AND expires_at > ?"
+SQL_CATEGORIES = (
+    "SELECT DISTINCT category FROM products "
+    "WHERE category IS NOT NULL AND category != '' ORDER BY category"
+)
+
+SQL_RELEASE_EXPIRED = (
+    "UPDATE products SET status='available' WHERE status='reserved' "
+    "AND id IN (SELECT product_id FROM holds WHERE expires_at <= ?)"
+)
+SQL_DELETE_EXPIRED = "DELETE FROM holds WHERE expires_at <= ?"
+
+SQL_RESERVE_PRODUCT = """
+    UPDATE products SET status='reserved'
+    WHERE id=? AND (
+      status='available'
+      OR (status='reserved' AND EXISTS (
+        SELECT 1 FROM holds WHERE product_id=? AND expires_at <= ?
+      ))
+    )
+    RETURNING name
+"""
+SQL_UPSERT_HOLD = """
+    INSERT INTO holds (session_id, product_id, created_at, expires_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(product_id) DO UPDATE SET
+      session_id=excluded.session_id,
+      created_at=excluded.created_at,
+      expires_at=excluded.expires_at
+"""
+SQL_HOLD_OWNER = "SELECT session_id FROM holds WHERE product_id=?"
+SQL_DELETE_HOLD = "DELETE FROM holds WHERE product_id=?"
+SQL_RELEASE_PRODUCT = "UPDATE products SET status='available' WHERE id=? AND status='reserved'"
+SQL_RELEASE_SESSION_PRODUCTS = (
+    "UPDATE products SET status='available' WHERE status='reserved' AND id IN ("
+    "SELECT product_id FROM holds WHERE session_id=?)"
+)
+SQL_CLEAR_SESSION_HOLDS = "DELETE FROM holds WHERE session_id=?"
+SQL_DELETE_SESSION_HOLDS = (
+    "DELETE FROM holds WHERE session_id=? AND product_id IN (SELECT value FROM json_each(?))"
+)
+
+SQL_INSERT_ORDER = """
+    INSERT INTO orders (order_code, name, phone, instagram, notes, total, item_count, status, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, 'reserved', ?)
+"""
+SQL_INSERT_ORDER_ITEM = """
+    INSERT INTO order_items (order_id, product_id, price, name, code, category, image_path)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+# solo se vende lo que esta sesión tiene retenido y vigente (params: sid, now, ids)
+SQL_MARK_SOLD = (
+    "UPDATE products SET status='sold' WHERE id IN ("
+    "SELECT product_id FROM holds WHERE session_id=? AND expires_at > ?) "
+    "AND id IN (SELECT value FROM json_each(?))"
+)
+SQL_ORDER_BY_CODE = "SELECT * FROM orders WHERE order_code=?"
+SQL_IMAGE_IN_ORDERS = "SELECT 1 FROM order_items WHERE image_path=? LIMIT 1"
+SQL_ORDERS_PAGE = """
+    SELECT id, order_code, name, phone, instagram, total, item_count, status, created_at
+    FROM orders
+    WHERE id < ?
+    ORDER BY id DESC
+    LIMIT ?
+"""
+SQL_ORDER_ITEMS = """
+    SELECT product_id AS id, name, code, category, image_path, price
+    FROM order_items
+    WHERE order_id = ?
+    ORDER BY order_items.id ASC
+"""
 
 
 # ---------------------------
@@ -41,126 +306,286 @@ def get_session_id() -> str:
     if not sid:
         sid = uuid.uuid4().hex
         session['sid'] = sid
+    # cookies viejas traían el carrito completo; ahora el carrito son los holds
+    session.pop('cart', None)
+    session.pop('cart_count', None)
     return sid
 
 
-def get_cart_ids() -> List[int]:
-    cart = session.get('cart', [])
-    if not isinstance(cart, list):
-        cart = []
-    # normalizar a int
-    out = []
-    for x in cart:
-        try:
-            out.append(int(x))
-        except:
-            pass
-    session['cart'] = out
-    session['cart_count'] = len(out)
-    return out
+def current_cart_count() -> int:
+    """
+    Holds vigentes de la sesión (una consulta por request, memorizada en g).
+    Toma su propia conexión: no llamarla (ni renderizar) dentro de un db_conn().
+    """
+    if 'cart_count' not in g:
+        sid = session.get('sid')  # no crear sid solo por renderizar el navbar
+        count = 0
+        if sid:
+            with db_conn() as conn:
+                cur = conn.cursor()
+                cur.execute(SQL_CART_COUNT, (sid, int(time.time())))
+                count = cur.fetchone()[0]
+        g.cart_count = count
+    return g.cart_count
 
 
-def set_cart_ids(cart_ids: List[int]) -> None:
-    session['cart'] = cart_ids
-    session['cart_count'] = len(cart_ids)
+@app.context_processor
+def inject_cart_count():
+    return {'cart_count': current_cart_count()}
 
 
 # ---------------------------
 # Inicialización / Migración DB
 # ---------------------------
+_db_ready = False
+_db_init_lock = threading.Lock()
+
+
 def init_db():
-    conn = get_db()
-    cur = conn.cursor()
-
-    # Tabla products (adaptada a Hot Wheels)
-    # Nota: arregla el error del script anterior: faltaba coma antes de external_link.
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            code TEXT UNIQUE,
-            category TEXT,
-            description TEXT,
-            price REAL NOT NULL DEFAULT 0,
-            status TEXT NOT NULL DEFAULT 'available', -- available | reserved | sold
-            image_path TEXT,
-            manufacturer TEXT,
-            plant TEXT,
-            unit TEXT,
-            quantity INTEGER DEFAULT 1,
-            external_link TEXT
-        )
-    """)
-
-    # Migración: agregar columnas si faltan
-    cur.execute("PRAGMA table_info(products)")
-    cols = [r[1] for r in cur.fetchall()]
-
-    def add_col_if_missing(col_name: str, ddl: str):
-        if col_name not in cols:
-            cur.execute(f"ALTER TABLE products ADD COLUMN {ddl}")
-
-    add_col_if_missing('code', "code TEXT")
-    add_col_if_missing('price', "price REAL NOT NULL DEFAULT 0")
-    add_col_if_missing('status', "status TEXT NOT NULL DEFAULT 'available'")
-    add_col_if_missing('category', "category TEXT")
-    add_col_if_missing('description', "description TEXT")
-    add_col_if_missing('image_path', "image_path TEXT")
-    add_col_if_missing('external_link', "external_link TEXT")
-    add_col_if_missing('quantity', "quantity INTEGER DEFAULT 1")
-
-    # Holds: reserva temporal por sesión
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS holds (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            product_id INTEGER NOT NULL UNIQUE,
-            created_at TEXT NOT NULL,
-            expires_at TEXT NOT NULL,
-            FOREIGN KEY(product_id) REFERENCES products(id)
-        )
-    """)
-
-    # Orders: reserva ya procesada con datos del cliente
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            order_code TEXT NOT NULL UNIQUE,
-            name TEXT NOT NULL,
-            phone TEXT NOT NULL,
-            instagram TEXT NOT NULL,
-            notes TEXT,
-            total REAL NOT NULL DEFAULT 0,
-            status TEXT NOT NULL DEFAULT 'reserved', -- reserved | contacted | paid | delivered | cancelled
-            created_at TEXT NOT NULL
-        )
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS order_items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            order_id INTEGER NOT NULL,
-            product_id INTEGER NOT NULL,
-            price REAL NOT NULL,
-            FOREIGN KEY(order_id) REFERENCES orders(id),
-            FOREIGN KEY(product_id) REFERENCES products(id)
-        )
-    """)
-
-    conn.commit()
-    conn.close()
+    """
+    Crea y migra el esquema. Se llama al importar el módulo (gunicorn nunca
+    ejecuta __main__); el lock evita correrlo dos veces en el mismo proceso.
+    """
+    global _db_ready
+    with _db_init_lock:
+        if _db_ready:
+            return
+
+        with db_conn() as conn:
+            cur = conn.cursor()
+
+            # WAL queda guardado en el archivo: los lectores no bloquean al escritor
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+
+            # todo el esquema/migración en una transacción: si varios workers
+            # arrancan a la vez, el segundo espera y ya encuentra todo migrado
+            cur.execute("BEGIN IMMEDIATE")
+
+            # Tabla products (adaptada a Hot Wheels)
+            # Nota: arregla el error del script anterior: faltaba coma antes de external_link.
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS products (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    code TEXT UNIQUE,
+                    category TEXT,
+                    description TEXT,
+                    price REAL NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'available', -- available | reserved | sold
+                    image_path TEXT,
+                    manufacturer TEXT,
+                    plant TEXT,
+                    unit TEXT,
+                    quantity INTEGER DEFAULT 1,
+                    external_link TEXT
+                )
+            """)
+
+            # Migración: agregar columnas si faltan
+            def add_col_if_missing(table: str, col_name: str, ddl: str):
+                cur.execute(f"PRAGMA table_info({table})")
+                if col_name not in [r[1] for r in cur.fetchall()]:
+                    cur.execute(f"ALTER TABLE {table} ADD COLUMN {ddl}")
+
+            add_col_if_missing('products', 'code', "code TEXT")
+            add_col_if_missing('products', 'price', "price REAL NOT NULL DEFAULT 0")
+            add_col_if_missing('products', 'status', "status TEXT NOT NULL DEFAULT 'available'")
+            add_col_if_missing('products', 'category', "category TEXT")
+            add_col_if_missing('products', 'description', "description TEXT")
+            add_col_if_missing('products', 'image_path', "image_path TEXT")
+            add_col_if_missing('products', 'external_link', "external_link TEXT")
+            add_col_if_missing('products', 'quantity', "quantity INTEGER DEFAULT 1")
+
+            # Holds: reserva temporal por sesión (tiempos en epoch UTC, segundos)
+            holds_ddl = """
+                CREATE TABLE IF NOT EXISTS {name} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    product_id INTEGER NOT NULL UNIQUE,
+                    created_at INTEGER NOT NULL,
+                    expires_at INTEGER NOT NULL,
+                    FOREIGN KEY(product_id) REFERENCES products(id)
+                )
+            """
+            cur.execute(holds_ddl.format(name='holds'))
+
+            # Migración: holds viejos guardaban ISO en columnas TEXT. Con afinidad
+            # TEXT un entero se compara como string, así que hay que reconstruir.
+            cur.execute("PRAGMA table_info(holds)")
+            if {r[1]: r[2] for r in cur.fetchall()}.get('expires_at', '').upper() == 'TEXT':
+                cur.execute(holds_ddl.format(name='holds_new'))
+                # un hold con fecha ilegible no se puede copiar: liberar su producto
+                cur.execute("""
+                    UPDATE products SET status='available' WHERE status='reserved'
+                    AND id IN (SELECT product_id FROM holds WHERE strftime('%s', expires_at) IS NULL)
+                """)
+                # el baseline no aplicaba foreign keys: puede haber holds de
+                # productos ya borrados, que con foreign_keys=ON romperían la copia
+                cur.execute("""
+                    INSERT INTO holds_new (id, session_id, product_id, created_at, expires_at)
+                    SELECT id, session_id, product_id,
+                           CAST(COALESCE(strftime('%s', created_at), strftime('%s', expires_at)) AS INTEGER),
+                           CAST(strftime('%s', expires_at) AS INTEGER)
+                    FROM holds
+                    WHERE product_id IN (SELECT id FROM products)
+                      AND strftime('%s', expires_at) IS NOT NULL
+                """)
+                cur.execute("DROP TABLE holds")
+                cur.execute("ALTER TABLE holds_new RENAME TO holds")
+
+            # Orders: reserva ya procesada con datos del cliente
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_code TEXT NOT NULL UNIQUE,
+                    name TEXT NOT NULL,
+                    phone TEXT NOT NULL,
+                    instagram TEXT NOT NULL,
+                    notes TEXT,
+                    total REAL NOT NULL DEFAULT 0,
+                    item_count INTEGER NOT NULL DEFAULT 0,
+                    status TEXT NOT NULL DEFAULT 'reserved', -- reserved | contacted | paid | delivered | cancelled
+                    created_at TEXT NOT NULL
+                )
+            """)
+
+            # borrar una orden borra sus items; borrar un producto deja la copia
+            order_items_ddl = """
+                CREATE TABLE IF NOT EXISTS {name} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_id INTEGER NOT NULL,
+                    product_id INTEGER,
+                    price REAL NOT NULL,
+                    -- copia del producto al momento del checkout (sobrevive a borrados)
+                    name TEXT,
+                    code TEXT,
+                    category TEXT,
+                    image_path TEXT,
+                    FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE,
+                    FOREIGN KEY(product_id) REFERENCES products(id) ON DELETE SET NULL
+                )
+            """
+            cur.execute(order_items_ddl.format(name='order_items'))
+
+            # Migración: snapshot del producto en order_items + item_count en orders
+            add_col_if_missing('orders', 'item_count', "item_count INTEGER NOT NULL DEFAULT 0")
+            add_col_if_missing('order_items', 'name', "name TEXT")
+            add_col_if_missing('order_items', 'code', "code TEXT")
+            add_col_if_missing('order_items', 'category', "category TEXT")
+            add_col_if_missing('order_items', 'image_path', "image_path TEXT")
+
+            # rellenar pedidos viejos desde products (solo los que no tienen copia)
+            cur.execute("""
+                UPDATE order_items SET
+                  name = (SELECT p.name FROM products p WHERE p.id = order_items.product_id),
+                  code = (SELECT p.code FROM products p WHERE p.id = order_items.product_id),
+                  category = (SELECT p.category FROM products p WHERE p.id = order_items.product_id),
+                  image_path = (SELECT p.image_path FROM products p WHERE p.id = order_items.product_id)
+                WHERE name IS NULL
+            """)
+            cur.execute("""
+                UPDATE orders SET
+                  item_count = (SELECT COUNT(*) FROM order_items oi WHERE oi.order_id = orders.id)
+                WHERE item_count = 0
+            """)
+
+            # Migración: sqlite no permite cambiar un FK, hay que reconstruir order_items
+            cur.execute("PRAGMA foreign_key_list(order_items)")
+            on_delete = {r['from']: r['on_delete'] for r in cur.fetchall()}
+            if on_delete.get('order_id') != 'CASCADE':
+                cur.execute(order_items_ddl.format(name='order_items_new'))
+                # items huérfanos (de órdenes ya borradas) no pasan el FK: se descartan
+                cur.execute("""
+                    INSERT INTO order_items_new (id, order_id, product_id, price, name, code, category, image_path)
+                    SELECT id, order_id,
+                           CASE WHEN product_id IN (SELECT id FROM products) THEN product_id END,
+                           price, name, code, category, image_path
+                    FROM order_items
+                    WHERE order_id IN (SELECT id FROM orders)
+                """)
+                cur.execute("DROP TABLE order_items")
+                cur.execute("ALTER TABLE order_items_new RENAME TO order_items")
+
+            # Índices para las columnas de WHERE/JOIN más usadas
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_holds_expires ON holds(expires_at)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_holds_session ON holds(session_id, product_id)")
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_products_category ON products(category) "
+                "WHERE category IS NOT NULL AND category != ''"
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_products_status ON products(status)")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id)")
+
+            # estadísticas para que el planner elija los índices
+            cur.execute("ANALYZE")
+
+            conn.commit()
+
+        _db_ready = True
 
 
 # ---------------------------
 # Logo dinámico
 # ---------------------------
+_SENTINEL = object()
+
+# solo cambia vía /upload_logo, así que se lista la carpeta una sola vez
+_LOGO_CACHE = {'file': _SENTINEL}
+
+
 def get_logo():
+    cached = _LOGO_CACHE['file']
+    if cached is not _SENTINEL:
+        return cached
+
     logo_dir = os.path.join('static', UPLOAD_FOLDER_LOGO)
     try:
         files = os.listdir(logo_dir)
-        return files[0] if files else None
+        logo = files[0] if files else None
     except:
+        logo = None
+    _LOGO_CACHE['file'] = logo
+    return logo
+
+
+# ---------------------------
+# Versión del catálogo (ETag)
+# ---------------------------
+# Cambia con cada escritura que afecta la vitrina; las páginas públicas la
+# usan en su ETag para responder 304 sin tocar la DB.
+PRODUCTS_VERSION = uuid.uuid4().hex
+
+
+def bump_products_version() -> None:
+    global PRODUCTS_VERSION
+    PRODUCTS_VERSION = uuid.uuid4().hex
+
+
+def page_etag(*parts) -> str:
+    # la página también depende de la sesión (badge del carrito, menú admin) y del logo
+    key = [PRODUCTS_VERSION, get_logo(), bool(session.get('admin')), current_cart_count(), *parts]
+    return hashlib.md5(":".join(str(p) for p in key).encode()).hexdigest()
+
+
+def not_modified(etag: str):
+    """
+    Respuesta 304 si el navegador ya tiene esta versión; None si hay que renderizar.
+    Con mensajes flash pendientes siempre se renderiza para mostrarlos.
+    """
+    if session.get('_flashes') or etag not in request.if_none_match:
         return None
+    resp = make_response('', 304)
+    resp.set_etag(etag)
+    return resp
+
+
+def with_etag(body: str, etag: str):
+    resp = make_response(body)
+    resp.set_etag(etag)
+    # privado (depende de la cookie) y siempre revalidar con el ETag
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
 
 
 # ---------------------------
@@ -170,44 +595,104 @@ def cleanup_expired_holds():
     """
     Libera productos cuya reserva temporal expiró.
     """
-    now_iso = datetime.utcnow().isoformat()
-    conn = get_db()
-    cur = conn.cursor()
+    now = int(time.time())
+    with db_conn() as conn:
+        cur = conn.cursor()
+        # sqlite no acepta DELETE ... RETURNING dentro de un CTE: UPDATE + DELETE
+        # en una sola transacción, ambos resueltos con idx_holds_expires
+        cur.execute("BEGIN IMMEDIATE")
 
-    # buscar holds expirados
-    cur.execute("SELECT product_id FROM holds WHERE expires_at <= ?", (now_iso,))
-    expired = [r['product_id'] for r in cur.fetchall()]
+        # marcar productos como available SOLO si estaban reserved
+        cur.execute(SQL_RELEASE_EXPIRED, (now,))
+        released = cur.rowcount
 
-    if expired:
         # eliminar holds expirados
-        cur.execute("DELETE FROM holds WHERE expires_at <= ?", (now_iso,))
+        cur.execute(SQL_DELETE_EXPIRED, (now,))
+
+        conn.commit()
+
+    if released:
+        bump_products_version()
 
-        # marcar productos como available SOLO si estaban reserved
-        cur.execute(
-            f"UPDATE products SET status='available' "
-            f"WHERE id IN ({','.join(['?']*len(expired))}) AND status='reserved'",
-            expired
-        )
 
-    conn.commit()
-    conn.close()
+_cleanup_started = False
+_cleanup_lock = threading.Lock()
+
+
+def _cleanup_loop():
+    while True:
+        try:
+            cleanup_expired_holds()
+        except Exception:
+            # cualquier error: registrarlo y seguir, el hilo no se vuelve a arrancar
+            app.logger.exception("Error limpiando holds expirados")
+        time.sleep(CLEANUP_INTERVAL)
+
+
+def start_cleanup_thread():
+    """
+    Arranca (una sola vez por proceso) el hilo que barre holds expirados
+    cada CLEANUP_INTERVAL segundos, en vez de limpiar en cada request.
+    """
+    global _cleanup_started
+    with _cleanup_lock:
+        if _cleanup_started:
+            return
+        _cleanup_started = True
+    threading.Thread(target=_cleanup_loop, name='holds-cleanup', daemon=True).start()
+
+
+@app.before_request
+def ensure_cleanup_thread():
+    # se arranca en el primer request y no al importar, para que con
+    # gunicorn --preload el hilo viva en el worker y no en el master
+    if not _cleanup_started:
+        start_cleanup_thread()
 
 
 # ---------------------------
 # Helpers de catálogo
 # ---------------------------
+# categorías cacheadas; add/edit/delete_product lo invalidan con exp=0.
+# 'gen' cambia en cada invalidación: una recarga que empezó antes no guarda.
+_CATEGORIES_CACHE = {'val': None, 'exp': 0, 'gen': object()}
+_categories_lock = threading.Lock()
+
+
+def invalidate_categories() -> None:
+    _CATEGORIES_CACHE['gen'] = object()
+    _CATEGORIES_CACHE['exp'] = 0
+
+
 def fetch_categories() -> List[str]:
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT category FROM products WHERE category IS NOT NULL AND category != '' ORDER BY category")
-    cats = [r['category'] for r in cur.fetchall()]
-    conn.close()
-    return cats
+    if time.time() < _CATEGORIES_CACHE['exp']:
+        return _CATEGORIES_CACHE['val']
+
+    # un solo hilo recarga; los demás esperan y usan el resultado
+    with _categories_lock:
+        if time.time() < _CATEGORIES_CACHE['exp']:
+            return _CATEGORIES_CACHE['val']
 
+        gen = _CATEGORIES_CACHE['gen']
+        with db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(SQL_CATEGORIES)
+            cats = [r['category'] for r in cur.fetchall()]
 
-def fetch_products(q: str = "", category: str = "") -> List[sqlite3.Row]:
-    query = "SELECT * FROM products WHERE 1=1"
-    params = []
+        # si hubo una escritura durante la recarga, no cachear datos viejos
+        if _CATEGORIES_CACHE['gen'] is gen:
+            _CATEGORIES_CACHE['val'] = cats
+            _CATEGORIES_CACHE['exp'] = time.time() + CATEGORIES_TTL
+        return cats
+
+
+def fetch_products(q: str = "", category: str = "") -> Iterator[sqlite3.Row]:
+    """
+    Itera los productos sin armar la lista completa en memoria: la conexión
+    queda tomada del pool hasta que el template termina de recorrerlos.
+    """
+    query = SQL_PRODUCTS_LIVE + " WHERE 1=1"
+    params = [int(time.time())]
 
     if q:
         query += " AND (name LIKE ? OR code LIKE ?)"
@@ -219,21 +704,17 @@ def fetch_products(q: str = "", category: str = "") -> List[sqlite3.Row]:
 
     query += " ORDER BY id DESC"
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(query, params)
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        yield from cur
 
 
 def fetch_product(product_id: int) -> Optional[sqlite3.Row]:
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE id=?", (product_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_PRODUCT_BY_ID, (int(time.time()), product_id))
+        return cur.fetchone()
 
 
 # ---------------------------
@@ -241,37 +722,43 @@ def fetch_product(product_id: int) -> Optional[sqlite3.Row]:
 # ---------------------------
 @app.route('/')
 def index():
-    cleanup_expired_holds()
-
     q = request.args.get('q', '').strip()
     category = request.args.get('category', '').strip()
 
+    etag = page_etag('index', q, category)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
     products = fetch_products(q=q, category=category)
     categories = fetch_categories()
 
-    return render_template(
+    return with_etag(render_template(
         'index.html',
         products=products,
         categories=categories,
         selected_category=category if category else "",
         q=q,
         logo_file=get_logo()
-    )
+    ), etag)
 
 
 @app.route('/product/<int:product_id>')
 def product_detail(product_id):
-    cleanup_expired_holds()
+    etag = page_etag('product', product_id)
+    cached = not_modified(etag)
+    if cached:
+        return cached
 
     product = fetch_product(product_id)
     if not product:
         abort(404)
 
-    return render_template(
+    return with_etag(render_template(
         'product_detail.html',
         product=product,
         logo_file=get_logo()
-    )
+    ), etag)
 
 
 # ---------------------------
@@ -279,82 +766,53 @@ def product_detail(product_id):
 # ---------------------------
 @app.route('/cart')
 def cart():
-    cleanup_expired_holds()
-
-    cart_ids = get_cart_ids()
-    if not cart_ids:
+    sid = session.get('sid')
+    if not sid:
         return render_template('cart.html', cart_items=[], total=0, logo_file=get_logo())
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        f"SELECT * FROM products WHERE id IN ({','.join(['?']*len(cart_ids))})",
-        cart_ids
-    )
-    items = cur.fetchall()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_CART_ITEMS, (sid, int(time.time())))
+        items = cur.fetchall()
 
-    # total
-    total = sum(float(i['price'] or 0) for i in items)
+    # total (calculado en SQL)
+    total = float(items[0]['cart_total']) if items else 0
 
     return render_template('cart.html', cart_items=items, total=total, logo_file=get_logo())
 
 
 @app.route('/cart/add/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
-    cleanup_expired_holds()
-
     sid = get_session_id()
-    cart_ids = get_cart_ids()
-
-    product = fetch_product(product_id)
-    if not product:
-        flash("Producto no encontrado.", "warning")
-        return redirect(url_for('index'))
-
-    # solo se reserva si está disponible
-    if product['status'] != 'available':
-        flash("Ese Hot Wheels ya no está disponible.", "warning")
-        return redirect(url_for('product_detail', product_id=product_id))
+    now = int(time.time())
+    expires = now + HOLD_MINUTES * 60
 
-    # crear hold + marcar reserved (operación “lo más atómica posible” en sqlite)
-    now = datetime.utcnow()
-    expires = now + timedelta(minutes=HOLD_MINUTES)
-
-    conn = get_db()
-    cur = conn.cursor()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
 
-    try:
-        # insertar hold (product_id UNIQUE evita duplicados)
-        cur.execute("""
-            INSERT INTO holds (session_id, product_id, created_at, expires_at)
-            VALUES (?, ?, ?, ?)
-        """, (sid, product_id, now.isoformat(), expires.isoformat()))
-
-        # marcar producto como reserved
-        cur.execute("UPDATE products SET status='reserved' WHERE id=? AND status='available'", (product_id,))
-        if cur.rowcount == 0:
-            # alguien lo ganó primero
+        # el límite se cuenta dentro de la transacción: dos pestañas no lo saltan
+        cur.execute(SQL_CART_COUNT, (sid, now))
+        if cur.fetchone()[0] >= MAX_CART_ITEMS:
             conn.rollback()
-            flash("Otro usuario reservó ese Hot Wheels antes que tú.", "warning")
-            conn.close()
+            flash(f"Tu carrito ya tiene el máximo de {MAX_CART_ITEMS} Hot Wheels.", "warning")
+            return redirect(url_for('cart'))
+
+        # reservar de forma optimista: solo gana si está available (o si su
+        # hold anterior ya expiró y el hilo de limpieza aún no pasó)
+        cur.execute(SQL_RESERVE_PRODUCT, (product_id, product_id, now))
+        product = cur.fetchone()
+        if product is None:
+            conn.rollback()
+            flash("Ese Hot Wheels ya no está disponible.", "warning")
             return redirect(url_for('product_detail', product_id=product_id))
 
-        conn.commit()
-
-    except sqlite3.IntegrityError:
-        # ya existe hold (otro usuario lo reservó)
-        conn.rollback()
-        flash("Ese Hot Wheels ya fue reservado.", "warning")
-        conn.close()
-        return redirect(url_for('product_detail', product_id=product_id))
+        # crear el hold; si quedó uno expirado para este producto, se reemplaza
+        cur.execute(SQL_UPSERT_HOLD, (sid, product_id, now, expires))
 
-    conn.close()
+        conn.commit()
 
-    # agregar al carrito de sesión
-    if product_id not in cart_ids:
-        cart_ids.append(product_id)
-        set_cart_ids(cart_ids)
+    bump_products_version()
 
     flash(f"Reservaste temporalmente: {product['name']} (por {HOLD_MINUTES} min).", "success")
     return redirect(url_for('cart'))
@@ -362,63 +820,49 @@ def add_to_cart(product_id):
 
 @app.route('/cart/remove/<int:product_id>', methods=['POST'])
 def remove_from_cart(product_id):
-    cleanup_expired_holds()
-
     sid = get_session_id()
-    cart_ids = get_cart_ids()
 
-    if product_id in cart_ids:
-        cart_ids.remove(product_id)
-        set_cart_ids(cart_ids)
+    # si el hold era de esta sesión, liberarlo (IMMEDIATE: se lee y luego se escribe)
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(SQL_HOLD_OWNER, (product_id,))
+        row = cur.fetchone()
 
-    # si el hold era de esta sesión, liberarlo
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT session_id FROM holds WHERE product_id=?", (product_id,))
-    row = cur.fetchone()
+        released = bool(row and row['session_id'] == sid)
+        if released:
+            cur.execute(SQL_DELETE_HOLD, (product_id,))
+            cur.execute(SQL_RELEASE_PRODUCT, (product_id,))
 
-    if row and row['session_id'] == sid:
-        cur.execute("DELETE FROM holds WHERE product_id=?", (product_id,))
-        cur.execute("UPDATE products SET status='available' WHERE id=? AND status='reserved'", (product_id,))
         conn.commit()
 
-    conn.close()
+    # después del commit: un ETag nuevo nunca debe servir datos viejos
+    if released:
+        bump_products_version()
+
     flash("Producto removido del carrito.", "info")
     return redirect(url_for('cart'))
 
 
 @app.route('/cart/clear')
 def clear_cart():
-    cleanup_expired_holds()
-
-    sid = get_session_id()
-    cart_ids = get_cart_ids()
+    sid = session.get('sid')
 
-    if cart_ids:
-        conn = get_db()
-        cur = conn.cursor()
+    if sid:
+        with db_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
 
-        # liberar holds propios
-        cur.execute(
-            f"SELECT product_id FROM holds WHERE session_id=? AND product_id IN ({','.join(['?']*len(cart_ids))})",
-            [sid] + cart_ids
-        )
-        mine = [r['product_id'] for r in cur.fetchall()]
+            # liberar holds propios (también los ya expirados)
+            cur.execute(SQL_RELEASE_SESSION_PRODUCTS, (sid,))
+            released = cur.rowcount
+            cur.execute(SQL_CLEAR_SESSION_HOLDS, (sid,))
 
-        if mine:
-            cur.execute(
-                f"DELETE FROM holds WHERE session_id=? AND product_id IN ({','.join(['?']*len(mine))})",
-                [sid] + mine
-            )
-            cur.execute(
-                f"UPDATE products SET status='available' WHERE id IN ({','.join(['?']*len(mine))}) AND status='reserved'",
-                mine
-            )
+            conn.commit()
 
-        conn.commit()
-        conn.close()
+        if released:
+            bump_products_version()
 
-    set_cart_ids([])
     flash("Carrito vaciado.", "info")
     return redirect(url_for('cart'))
 
@@ -428,118 +872,85 @@ def clear_cart():
 # ---------------------------
 @app.route('/checkout', methods=['GET', 'POST'])
 def checkout():
-    cleanup_expired_holds()
-
     sid = get_session_id()
-    cart_ids = get_cart_ids()
-
-    if not cart_ids:
-        flash("Tu carrito está vacío.", "warning")
-        return redirect(url_for('index'))
-
-    # cargar items
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        f"SELECT * FROM products WHERE id IN ({','.join(['?']*len(cart_ids))})",
-        cart_ids
-    )
-    items = cur.fetchall()
 
-    # validar que siguen reservados por esta sesión
-    cur.execute(
-        f"SELECT product_id FROM holds WHERE session_id=? AND product_id IN ({','.join(['?']*len(cart_ids))})",
-        [sid] + cart_ids
-    )
-    held_by_me = set([r['product_id'] for r in cur.fetchall()])
-
-    # si falta alguno, sacarlo del carrito
-    valid_items = [i for i in items if i['id'] in held_by_me]
-    invalid = [i['id'] for i in items if i['id'] not in held_by_me]
-
-    if invalid:
-        cart_ids = [i for i in cart_ids if i not in invalid]
-        set_cart_ids(cart_ids)
-        flash("Algunos productos ya no estaban reservados y se removieron del carrito.", "warning")
-
-    if not valid_items:
-        conn.close()
-        flash("No tienes productos reservados actualmente.", "warning")
-        return redirect(url_for('cart'))
-
-    total = sum(float(i['price'] or 0) for i in valid_items)
-
-    if request.method == 'GET':
-        conn.close()
-        return render_template('checkout.html', cart_items=valid_items, total=total, logo_file=get_logo())
-
-    # POST: crear orden
-    name = request.form.get('name', '').strip()
-    phone = request.form.get('phone', '').strip()
-    instagram = request.form.get('instagram', '').strip()
-    notes = request.form.get('notes', '').strip()
-
-    if not name or not phone or not instagram:
-        conn.close()
-        flash("Completa nombre, teléfono e Instagram.", "danger")
-        return render_template('checkout.html', cart_items=valid_items, total=total, logo_file=get_logo())
-
-    order_code = "HW-" + uuid.uuid4().hex[:8].upper()
-    now_iso = datetime.utcnow().isoformat()
-
-    # crear order
-    cur.execute("""
-        INSERT INTO orders (order_code, name, phone, instagram, notes, total, status, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, 'reserved', ?)
-    """, (order_code, name, phone, instagram, notes, total, now_iso))
-    order_id = cur.lastrowid
-
-    # order_items + marcar productos sold + borrar holds
-    for it in valid_items:
-        cur.execute("""
-            INSERT INTO order_items (order_id, product_id, price)
-            VALUES (?, ?, ?)
-        """, (order_id, it['id'], float(it['price'] or 0)))
-
-        cur.execute("UPDATE products SET status='sold' WHERE id=?", (it['id'],))
-
-    cur.execute(
-        f"DELETE FROM holds WHERE session_id=? AND product_id IN ({','.join(['?']*len(held_by_me))})",
-        [sid] + list(held_by_me)
-    )
+    with db_conn() as conn:
+        cur = conn.cursor()
+
+        # POST: el lock de escritura va ANTES de validar los holds, para que nadie
+        # los libere ni los re-reserve entre la lectura y el UPDATE a sold
+        if request.method == 'POST':
+            cur.execute("BEGIN IMMEDIATE")
+
+        # cargar items: solo los que siguen reservados por esta sesión (sin expirar)
+        now = int(time.time())
+        cur.execute(SQL_SESSION_ITEMS, (sid, now))
+        valid_items = cur.fetchall()
+
+        if not valid_items:
+            conn.rollback()
+            flash("Tu carrito está vacío.", "warning")
+            return redirect(url_for('index'))
+
+        total = sum(float(i['price'] or 0) for i in valid_items)
+        # son justo los holds vigentes: el navbar no necesita otra conexión
+        g.cart_count = len(valid_items)
+
+        if request.method == 'GET':
+            return render_template('checkout.html', cart_items=valid_items, total=total, logo_file=get_logo())
+
+        # POST: crear orden
+        name = request.form.get('name', '').strip()
+        phone = request.form.get('phone', '').strip()
+        instagram = request.form.get('instagram', '').strip()
+        notes = request.form.get('notes', '').strip()
+
+        if not name or not phone or not instagram:
+            conn.rollback()
+            flash("Completa nombre, teléfono e Instagram.", "danger")
+            return render_template('checkout.html', cart_items=valid_items, total=total, logo_file=get_logo())
+
+        order_code = "HW-" + uuid.uuid4().hex[:8].upper()
+        now_iso = datetime.utcnow().isoformat()
+        ids_json = json.dumps([it['id'] for it in valid_items])
+
+        # crear order
+        cur.execute(SQL_INSERT_ORDER, (order_code, name, phone, instagram, notes, total, len(valid_items), now_iso))
+        order_id = cur.lastrowid
 
-    conn.commit()
-    conn.close()
+        # order_items + marcar productos sold + borrar holds (en lote)
+        items_rows = [
+            (order_id, it['id'], float(it['price'] or 0), it['name'], it['code'], it['category'], it['image_path'])
+            for it in valid_items
+        ]
+        cur.executemany(SQL_INSERT_ORDER_ITEM, items_rows)
+        # mismo filtro (sid, now) que SQL_SESSION_ITEMS y bajo el mismo lock de
+        # escritura tomado antes de leer: marca exactamente valid_items
+        cur.execute(SQL_MARK_SOLD, (sid, now, ids_json))
 
-    # limpiar carrito
-    set_cart_ids([])
+        cur.execute(SQL_DELETE_SESSION_HOLDS, (sid, ids_json))
+
+        conn.commit()
+
+    bump_products_version()
 
     return redirect(url_for('success', order_code=order_code))
 
 
 @app.route('/success/<order_code>')
 def success(order_code):
-    conn = get_db()
-    cur = conn.cursor()
-
-    # 1) Traer la orden
-    cur.execute("SELECT * FROM orders WHERE order_code=?", (order_code,))
-    order = cur.fetchone()
-    if not order:
-        conn.close()
-        abort(404)
+    with db_conn() as conn:
+        cur = conn.cursor()
 
-    # 2) Traer los items del pedido
-    cur.execute("""
-        SELECT p.id, p.name, p.price
-        FROM order_items oi
-        JOIN products p ON p.id = oi.product_id
-        WHERE oi.order_id = ?
-        ORDER BY oi.id ASC
-    """, (order['id'],))
-    items = cur.fetchall()
+        # 1) Traer la orden
+        cur.execute(SQL_ORDER_BY_CODE, (order_code,))
+        order = cur.fetchone()
+        if not order:
+            abort(404)
 
-    conn.close()
+        # 2) Traer los items del pedido
+        cur.execute(SQL_ORDER_ITEMS, (order['id'],))
+        items = cur.fetchall()
 
     return render_template(
         'success.html',
@@ -557,13 +968,30 @@ def success(order_code):
 # ---------------------------
 # Login Admin
 # ---------------------------
+def check_admin_credentials(user: str, password: str) -> bool:
+    """
+    Compara usuario y contraseña en tiempo constante contra los hashes del entorno.
+    """
+    if not ADMIN_USER_HASH or not ADMIN_PW_HASH:
+        return False
+
+    user_ok = hmac.compare_digest(hashlib.sha256(user.encode()).hexdigest(), ADMIN_USER_HASH)
+    try:
+        pw_ok = check_password_hash(ADMIN_PW_HASH, password)
+    except ValueError:
+        # hash mal formado en ADMIN_PW_HASH
+        pw_ok = False
+    # se evalúan ambos siempre para no revelar cuál falló
+    return user_ok and pw_ok
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     logo_file = get_logo()
     if request.method == 'POST':
         user = request.form.get('username', '')
         password = request.form.get('password', '')
-        if user == 'eldrige.rios' and password == '@141225Eer@':
+        if check_admin_credentials(user, password):
             session['admin'] = True
             flash("Sesión iniciada.", "success")
             return redirect(url_for('inventario_producto'))
@@ -581,63 +1009,79 @@ def logout():
 # ---------------------------
 # Admin: Inventario / CRUD
 # ---------------------------
+MAX_ROW_ID = 2**63 - 1
+
+
+def page_args():
+    """
+    Paginación por keyset: ?cursor=<último id visto>&limit=<n>.
+    """
+    cursor = request.args.get('cursor', type=int) or MAX_ROW_ID
+    limit = request.args.get('limit', ADMIN_PAGE_SIZE, type=int)
+    return cursor, max(1, min(limit, ADMIN_PAGE_MAX))
+
+
+def fetch_page(cur, limit: int):
+    # se pide una fila extra solo para saber si hay página siguiente
+    rows = cur.fetchmany(limit + 1)
+    next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
 @app.route('/admin')
 
 def inventario_producto():
     if not session.get('admin'):
         return redirect(url_for('login'))
 
-    cleanup_expired_holds()
-
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products ORDER BY id DESC")
-    productos = cur.fetchall()
-    conn.close()
+    cursor, limit = page_args()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_INVENTORY_PAGE, (int(time.time()), cursor, limit + 1))
+        productos, next_cursor = fetch_page(cur, limit)
 
-    return render_template('inventario_producto.html', productos=productos, logo_file=get_logo())
+    return render_template(
+        'inventario_producto.html',
+        productos=productos,
+        next_cursor=next_cursor,
+        is_first_page=cursor == MAX_ROW_ID,
+        limit=limit,
+        logo_file=get_logo()
+    )
 
 @app.route('/admin/orders')
 def admin_orders():
     if not session.get('admin'):
         return redirect(url_for('login'))
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT id, order_code, name, phone, instagram, total, status, created_at
-        FROM orders
-        ORDER BY id DESC
-    """)
-    orders = cur.fetchall()
-    conn.close()
+    cursor, limit = page_args()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL_ORDERS_PAGE, (cursor, limit + 1))
+        orders, next_cursor = fetch_page(cur, limit)
 
-    return render_template('admin_orders.html', orders=orders, logo_file=get_logo())
+    return render_template(
+        'admin_orders.html',
+        orders=orders,
+        next_cursor=next_cursor,
+        is_first_page=cursor == MAX_ROW_ID,
+        limit=limit,
+        logo_file=get_logo()
+    )
 
 @app.route('/admin/orders/<order_code>/delete', methods=['POST'])
 def admin_order_delete(order_code):
     if not session.get('admin'):
         return redirect(url_for('login'))
 
-    conn = get_db()
-    cur = conn.cursor()
-
-    # Buscar la orden
-    cur.execute("SELECT id FROM orders WHERE order_code=?", (order_code,))
-    order = cur.fetchone()
-    if not order:
-        conn.close()
-        flash("Reserva no encontrada.", "warning")
-        return redirect(url_for('admin_orders'))
-
-    order_id = order['id']
-
-    # Borrar items y luego la orden
-    cur.execute("DELETE FROM order_items WHERE order_id=?", (order_id,))
-    cur.execute("DELETE FROM orders WHERE id=?", (order_id,))
+    with db_conn() as conn:
+        cur = conn.cursor()
 
-    conn.commit()
-    conn.close()
+        # ON DELETE CASCADE borra también sus order_items
+        cur.execute("DELETE FROM orders WHERE order_code=? RETURNING id", (order_code,))
+        if cur.fetchone() is None:
+            flash("Reserva no encontrada.", "warning")
+            return redirect(url_for('admin_orders'))
 
     flash("Reserva eliminada.", "success")
     return redirect(url_for('admin_orders'))
@@ -649,25 +1093,17 @@ def admin_order_detail(order_code):
     if not session.get('admin'):
         return redirect(url_for('login'))
 
-    conn = get_db()
-    cur = conn.cursor()
+    with db_conn() as conn:
+        cur = conn.cursor()
 
-    cur.execute("SELECT * FROM orders WHERE order_code=?", (order_code,))
-    order = cur.fetchone()
-    if not order:
-        conn.close()
-        abort(404)
+        cur.execute(SQL_ORDER_BY_CODE, (order_code,))
+        order = cur.fetchone()
+        if not order:
+            abort(404)
 
-    cur.execute("""
-        SELECT p.id, p.name, p.code, p.category, p.image_path, oi.price
-        FROM order_items oi
-        JOIN products p ON p.id = oi.product_id
-        WHERE oi.order_id = ?
-        ORDER BY oi.id ASC
-    """, (order['id'],))
-    items = cur.fetchall()
+        cur.execute(SQL_ORDER_ITEMS, (order['id'],))
+        items = cur.fetchall()
 
-    conn.close()
     return render_template('admin_order_detail.html', order=order, items=items, logo_file=get_logo())
 
 
@@ -682,30 +1118,14 @@ def admin_order_update_status(order_code):
         flash("Estado inválido.", "danger")
         return redirect(url_for('admin_order_detail', order_code=order_code))
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("UPDATE orders SET status=? WHERE order_code=?", (new_status, order_code))
-    conn.commit()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE orders SET status=? WHERE order_code=?", (new_status, order_code))
 
     flash("Estado actualizado.", "success")
     return redirect(url_for('admin_order_detail', order_code=order_code))
 
 
-def inventario_producto():
-    if not session.get('admin'):
-        return redirect(url_for('login'))
-
-    cleanup_expired_holds()
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products ORDER BY id DESC")
-    productos = cur.fetchall()
-    conn.close()
-
-    return render_template('inventario_producto.html', productos=productos, logo_file=get_logo())
-
-
 @app.route('/add', methods=['GET', 'POST'])
 def add_product():
     if not session.get('admin'):
@@ -721,12 +1141,14 @@ def add_product():
 
         image = request.files.get('image')
         img_path = ''
+        img_data = None
 
+        # se lee el upload ya; el archivo se escribe después de guardar la fila
         if image and image.filename:
             ext = os.path.splitext(image.filename)[1].lower()
             fn = f"{uuid.uuid4().hex}{ext}"
             img_path = os.path.join(UPLOAD_FOLDER_IMAGES, fn).replace("\\", "/")
-            image.save(os.path.join('static', img_path))
+            img_data = image.stream.read()
 
         try:
             price_val = float(price)
@@ -737,21 +1159,27 @@ def add_product():
             flash("El nombre es obligatorio.", "danger")
             return render_template('add_product.html', logo_file=get_logo())
 
-        conn = get_db()
-        cur = conn.cursor()
-        try:
-            cur.execute("""
-                INSERT INTO products (name, code, category, description, price, status, image_path, quantity)
-                VALUES (?, ?, ?, ?, ?, ?, ?, 1)
-            """, (name, code, category, description, price_val, status, img_path))
-            conn.commit()
-        except sqlite3.IntegrityError:
-            conn.rollback()
+        with db_conn() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("""
+                    INSERT INTO products (name, code, category, description, price, status, image_path, quantity)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+                """, (name, code, category, description, price_val, status, img_path))
+                duplicate = False
+            except sqlite3.IntegrityError:
+                duplicate = True
+
+        # renderizar ya con la conexión devuelta al pool
+        if duplicate:
             flash("El código ya existe. Usa otro.", "danger")
-            conn.close()
             return render_template('add_product.html', logo_file=get_logo())
 
-        conn.close()
+        if img_data is not None:
+            submit_io(_write_bytes, os.path.join('static', img_path), img_data)
+
+        invalidate_categories()
+        bump_products_version()
         flash("Producto agregado.", "success")
         return redirect(url_for('inventario_producto'))
 
@@ -763,71 +1191,74 @@ def edit_product(product_id):
     if not session.get('admin'):
         return redirect(url_for('login'))
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE id=?", (product_id,))
-    producto = cur.fetchone()
-    if not producto:
-        conn.close()
-        abort(404)
-
-    if request.method == 'POST':
-        name = request.form.get('name', '').strip()
-        code = request.form.get('code', '').strip()
-        category = request.form.get('category', '').strip()
-        description = request.form.get('description', '').strip()
-        price = request.form.get('price', '0').strip()
-        status = request.form.get('status', 'available').strip()
-
-        # si hay holds, mejor no dejarlo available (regla simple)
-        # (puedes quitar esto si quieres)
-        cur.execute("SELECT 1 FROM holds WHERE product_id=?", (product_id,))
-        has_hold = cur.fetchone() is not None
-        if has_hold and status == 'available':
-            status = 'reserved'
-
-        # imagen
-        img_path = producto['image_path']
-        image = request.files.get('image')
-        if image and image.filename:
-            if img_path:
-                try:
-                    os.remove(os.path.join('static', img_path))
-                except:
-                    pass
-            ext = os.path.splitext(image.filename)[1].lower()
-            fn = f"{uuid.uuid4().hex}{ext}"
-            img_path = os.path.join(UPLOAD_FOLDER_IMAGES, fn).replace("\\", "/")
-            image.save(os.path.join('static', img_path))
-
-        try:
-            price_val = float(price)
-        except:
-            price_val = 0.0
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM products WHERE id=?", (product_id,))
+        producto = cur.fetchone()
+        if not producto:
+            abort(404)
+
+        if request.method == 'POST':
+            name = request.form.get('name', '').strip()
+            code = request.form.get('code', '').strip()
+            category = request.form.get('category', '').strip()
+            description = request.form.get('description', '').strip()
+            price = request.form.get('price', '0').strip()
+            status = request.form.get('status', 'available').strip()
+
+            # si hay holds, mejor no dejarlo available (regla simple)
+            # (puedes quitar esto si quieres)
+            cur.execute(
+                "SELECT 1 FROM holds WHERE product_id=? AND expires_at > ?",
+                (product_id, int(time.time()))
+            )
+            has_hold = cur.fetchone() is not None
+            if has_hold and status == 'available':
+                status = 'reserved'
+
+            # imagen: nombre nuevo calculado ya, disco después del UPDATE
+            old_img_path = producto['image_path']
+            img_path = old_img_path
+            img_data = None
+            image = request.files.get('image')
+            if image and image.filename:
+                ext = os.path.splitext(image.filename)[1].lower()
+                fn = f"{uuid.uuid4().hex}{ext}"
+                img_path = os.path.join(UPLOAD_FOLDER_IMAGES, fn).replace("\\", "/")
+                img_data = image.stream.read()
 
-        if not name:
-            conn.close()
-            flash("El nombre es obligatorio.", "danger")
-            return redirect(url_for('edit_product', product_id=product_id))
+            try:
+                price_val = float(price)
+            except:
+                price_val = 0.0
 
-        try:
-            cur.execute("""
-                UPDATE products SET
-                  name=?, code=?, category=?, description=?, price=?, status=?, image_path=?
-                WHERE id=?
-            """, (name, code, category, description, price_val, status, img_path, product_id))
-            conn.commit()
-        except sqlite3.IntegrityError:
-            conn.rollback()
-            flash("El código ya existe. Usa otro.", "danger")
-            conn.close()
-            return redirect(url_for('edit_product', product_id=product_id))
+            if not name:
+                flash("El nombre es obligatorio.", "danger")
+                return redirect(url_for('edit_product', product_id=product_id))
 
-        conn.close()
-        flash("Producto actualizado.", "success")
-        return redirect(url_for('inventario_producto'))
+            try:
+                cur.execute("""
+                    UPDATE products SET
+                      name=?, code=?, category=?, description=?, price=?, status=?, image_path=?
+                    WHERE id=?
+                """, (name, code, category, description, price_val, status, img_path, product_id))
+            except sqlite3.IntegrityError:
+                flash("El código ya existe. Usa otro.", "danger")
+                return redirect(url_for('edit_product', product_id=product_id))
+
+            if img_data is not None:
+                submit_io(_write_bytes, os.path.join('static', img_path), img_data)
+                # la imagen vieja se queda si alguna orden la guardó en su snapshot
+                if old_img_path:
+                    cur.execute(SQL_IMAGE_IN_ORDERS, (old_img_path,))
+                    if cur.fetchone() is None:
+                        submit_io(_remove_quietly, os.path.join('static', old_img_path))
+
+            invalidate_categories()
+            bump_products_version()
+            flash("Producto actualizado.", "success")
+            return redirect(url_for('inventario_producto'))
 
-    conn.close()
     return render_template('edit_product.html', producto=producto, logo_file=get_logo())
 
 @app.route('/upload_logo', methods=['POST'])
@@ -838,16 +1269,10 @@ def upload_logo():
     logo = request.files.get('logo')
     if logo and logo.filename:
         folder = os.path.join('static', UPLOAD_FOLDER_LOGO)
-        for f in os.listdir(folder):
-            try:
-                os.remove(os.path.join(folder, f))
-            except:
-                pass
-
         ext = os.path.splitext(logo.filename)[1].lower()
         fn = "logo" + ext
         path = os.path.join(UPLOAD_FOLDER_LOGO, fn).replace("\\", "/")
-        logo.save(os.path.join('static', path))
+        submit_io(_replace_logo, folder, os.path.join('static', path), logo.stream.read())
         flash("Logo actualizado", 'success')
 
     return redirect(url_for('inventario_producto'))
@@ -857,40 +1282,48 @@ def delete_product(product_id):
     if not session.get('admin'):
         return redirect(url_for('login'))
 
-    conn = get_db()
-    cur = conn.cursor()
+    with db_conn() as conn:
+        cur = conn.cursor()
 
-    # Opcional: impedir borrar si está reservado
-    cur.execute("SELECT status, image_path FROM products WHERE id=?", (product_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        abort(404)
+        # Opcional: impedir borrar si está reservado
+        cur.execute("SELECT status, image_path FROM products WHERE id=?", (product_id,))
+        row = cur.fetchone()
+        if not row:
+            abort(404)
 
-    if row['status'] == 'reserved':
-        conn.close()
-        flash("No puedes eliminar un producto reservado. Libéralo o espera a que expire.", "warning")
-        return redirect(url_for('inventario_producto'))
+        if row['status'] == 'reserved':
+            flash("No puedes eliminar un producto reservado. Libéralo o espera a que expire.", "warning")
+            return redirect(url_for('inventario_producto'))
 
-    img_path = row['image_path']
+        img_path = row['image_path']
+
+        # con foreign_keys=ON sqlite no deja borrar un producto referenciado
+        try:
+            cur.execute("DELETE FROM products WHERE id=?", (product_id,))
+        except sqlite3.IntegrityError:
+            flash("No puedes eliminar un producto que tiene reservas asociadas. Márcalo como vendido.", "warning")
+            return redirect(url_for('inventario_producto'))
 
-    cur.execute("DELETE FROM products WHERE id=?", (product_id,))
-    conn.commit()
-    conn.close()
+        # las órdenes guardan image_path: si alguna lo usa, la imagen se queda
+        if img_path:
+            cur.execute(SQL_IMAGE_IN_ORDERS, (img_path,))
+            if cur.fetchone() is not None:
+                img_path = None
 
-    # borrar la imagen del disco si existe
+    invalidate_categories()
+    bump_products_version()
+
+    # borrar la imagen del disco si existe y ninguna orden la usa
     if img_path:
-        try:
-            os.remove(os.path.join('static', img_path))
-        except:
-            pass
+        submit_io(_remove_quietly, os.path.join('static', img_path))
 
     flash("Producto eliminado.", "success")
     return redirect(url_for('inventario_producto'))
 
 
-if __name__ == '__main__':
-    init_db()
-    app.run(debug=True, host='0.0.0.0', port=5000)
+# esquema listo antes de atender requests, también bajo gunicorn
+init_db()
 
 
+if __name__ == '__main__':
+    app.run(debug=True, host='0.0.0.0', port=5000)